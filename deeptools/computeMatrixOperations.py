@@ -6,6 +6,7 @@ import argparse
 import sys
 import os
 import csv
+import warnings
 from deeptools._version import __version__
 
 
@@ -420,29 +421,22 @@ def filterHeatmap(hm, args):
 
 
 def filterHeatmapValues(hm, minVal, maxVal):
-    bounds = [0]
-    regions = []
-    keep = []
     if minVal is None:
         minVal = -np.inf
     if maxVal is None:
         maxVal = np.inf
-    np.warnings.filterwarnings('ignore')
-    for i, (x, y) in enumerate(zip(np.nanmin(hm.matrix.matrix, axis=1), np.nanmax(hm.matrix.matrix, axis=1))):
-        # x/y will be nan iff a row is entirely nan. Don't filter.
-        if np.isnan(x) or (x >= minVal and y <= maxVal):
-            keep.append(True)
-            regions.append(hm.matrix.regions[i])
-        else:
-            keep.append(False)
-    keep = np.array(keep)
+    with warnings.catch_warnings():
+        # all-nan rows raise a RuntimeWarning
+        warnings.simplefilter('ignore', RuntimeWarning)
+        rowMin = np.nanmin(hm.matrix.matrix, axis=1)
+        rowMax = np.nanmax(hm.matrix.matrix, axis=1)
+    # rowMin/rowMax will be nan iff a row is entirely nan. Don't filter.
+    keep = np.isnan(rowMin) | ((rowMin >= minVal) & (rowMax <= maxVal))
+    regions = [region for region, k in zip(hm.matrix.regions, keep.tolist()) if k]
 
     # Get the new bounds
-    for idx in range(1, len(hm.matrix.group_boundaries)):
-        i = int(np.sum(keep[hm.matrix.group_boundaries[idx - 1]:hm.matrix.group_boundaries[idx]]))
-        bounds.append(bounds[idx - 1] + i)
-
-    hm.matrix.group_boundaries = bounds
+    bounds = np.concatenate([[0], np.cumsum(keep)])[hm.matrix.group_boundaries]
+    hm.matrix.group_boundaries = bounds.tolist()
 
     # subset the matrix
     hm.matrix.matrix = hm.matrix.matrix[keep, :]
@@ -1,5 +1,6 @@
 import sys
 import gzip
+import warnings
 from collections import OrderedDict
 import numpy as np
 from copy import deepcopy
@@ -761,6 +762,7 @@ class heatmapper(object):
         matrix_rows = []
         current_group_index = 0
         max_group_bound = None
+        num_values = None
 
         fh = gzip.open(matrix_file)
         for line in fh:
@@ -772,12 +774,15 @@ class heatmapper(object):
                 # json
                 self.parameters = json.loads(line[1:].strip())
                 max_group_bound = self.parameters['group_boundaries'][1]
+                num_values = self.parameters['sample_boundaries'][-1]
                 continue
 
-            # split the line into bed interval and matrix values
-            region = line.split('\t')
-            chrom, start, end, name, score, strand = region[0:6]
-            matrix_row = np.ma.masked_invalid(np.fromiter(region[6:], np.float))
+            # split the line into bed interval and matrix values,
+            # the values of all rows are parsed at once below
+            chrom, start, end, name, score, strand, matrix_row = line.split('\t', 6)
+            if matrix_row.count('\t') + 1 != num_values:
+                raise ValueError("Region {} in {} has {} values, but {} are expected".format(
+                    name, matrix_file, matrix_row.count('\t') + 1, num_values))
             matrix_rows.append(matrix_row)
             starts = start.split(",")
             ends = end.split(",")
@@ -788,7 +793,24 @@ class heatmapper(object):
                 max_group_bound = self.parameters['group_boundaries'][current_group_index + 1]
             regions.append([chrom, regs, name, max_group_bound, strand, score])
 
-        matrix = np.vstack(matrix_rows)
+        with warnings.catch_warnings():
+            # np.fromstring stops at the first value it can not parse, with
+            # only a DeprecationWarning (a ValueError in newer numpy versions)
+            warnings.simplefilter('ignore', DeprecationWarning)
+            try:
+                matrix = np.fromstring("\t".join(matrix_rows), sep="\t")
+            except ValueError:
+                matrix = np.empty(0)
+        if matrix.size != len(regions) * num_values:
+            # the number of values per row is checked above, thus some value
+            # is not a number. The offending line is searched to report it
+            for region, matrix_row in zip(regions, matrix_rows):
+                try:
+                    np.array(matrix_row.split('\t'), dtype=float)
+                except ValueError:
+                    raise ValueError("The values of region {} in {} can not be read as numbers".format(region[2], matrix_file))
+            raise ValueError("The values in {} can not be read".format(matrix_file))
+        matrix = np.ma.asarray(matrix.reshape(len(regions), num_values))
         self.matrix = _matrix(regions, matrix, self.parameters['group_boundaries'],
                               self.parameters['sample_boundaries'],
                               group_labels=self.parameters['group_labels'],
@@ -1059,21 +1081,34 @@ class heatmapper(object):
         return matrixCols
 
 
-def computeSilhouetteScore(d, idx, labels):
+def computeSilhouetteScores(d, rowLabels, labels, k):
     """
-    Given a square distance matrix with NaN diagonals, compute the silhouette score
-    of a given row (idx). Each row should have an associated label (labels).
+    Given the distances of a block of rows to all rows, with NaN for the
+    distance of each row to itself, compute the silhouette scores of the rows
+    in the block. Each row should have an associated label (rowLabels for the
+    block and labels for all rows), between 0 and k - 1. NaN distances are ignored.
+
+    >>> d = np.array([[np.nan, 1., 4., 6.], [1., np.nan, 2., 4.]])
+    >>> computeSilhouetteScores(d, np.array([0, 0]), np.array([0, 0, 0, 1]), 2).tolist()
+    [0.5833333333333334, 0.625]
     """
-    keep = ~np.isnan(d[idx, ])
-    foo = np.bincount(labels[keep], weights=d[idx, ][keep])
-    groupSizes = np.bincount(labels[keep])
-    intraIdx = labels[idx]
-    if groupSizes[intraIdx] == 1:
-        return 0
-    intra = foo[labels[idx]] / groupSizes[intraIdx]
-    interMask = np.arange(len(foo))[np.arange(len(foo)) != labels[idx]]
-    inter = np.min(foo[interMask] / groupSizes[interMask])
-    return (inter - intra) / max(inter, intra)
+    valid = ~np.isnan(d)
+    onehot = (labels[:, np.newaxis] == np.arange(k)).astype(float)
+    # the sum of distances and the number of rows per label
+    sums = np.where(valid, d, 0).dot(onehot)
+    groupSizes = valid.astype(float).dot(onehot)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        meanDist = sums / groupSizes
+    rows = np.arange(len(rowLabels))
+    intraSizes = groupSizes[rows, rowLabels]
+    intra = meanDist[rows, rowLabels]
+    meanDist[groupSizes == 0] = np.inf
+    meanDist[rows, rowLabels] = np.inf
+    inter = meanDist.min(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (inter - intra) / np.maximum(inter, intra)
+    scores[(intraSizes <= 1) | ~np.isfinite(scores)] = 0
+    return scores
 
 
 class _matrix(object):
@@ -1140,7 +1175,9 @@ class _matrix(object):
         sample_start = self.sample_boundaries[sample]
         sample_end = self.sample_boundaries[sample + 1]
 
-        return {'matrix': np.ma.masked_invalid(self.matrix[group_start:group_end, :][:, sample_start:sample_end]),
+        # a single 2D slice gives a view whose rows are contiguous in memory,
+        # regardless of whether groups or samples are iterated first
+        return {'matrix': np.ma.masked_invalid(self.matrix[group_start:group_end, sample_start:sample_end]),
                 'group': self.group_labels[group],
                 'sample': self.sample_labels[sample]}
 
@@ -1215,37 +1252,31 @@ class _matrix(object):
             for x in self.regions:
                 matrix_avgs.append(np.sum([bar[1] - bar[0] for bar in x[1]]))
             matrix_avgs = np.array(matrix_avgs)
-        elif sort_using == 'mean':
-            matrix_avgs = np.nanmean(matrix, axis=1)
-        elif sort_using == 'mean':
-            matrix_avgs = np.nanmean(matrix, axis=1)
-        elif sort_using == 'median':
-            matrix_avgs = np.nanmedian(matrix, axis=1)
-        elif sort_using == 'max':
-            matrix_avgs = np.nanmax(matrix, axis=1)
-        elif sort_using == 'min':
-            matrix_avgs = np.nanmin(matrix, axis=1)
-        elif sort_using == 'sum':
-            matrix_avgs = np.nansum(matrix, axis=1)
+        elif sort_using in ['mean', 'median', 'max', 'min', 'sum']:
+            # the nan functions copy the matrix, and np.nanmedian sorts each
+            # row, thus they are only used if there are nan values
+            if np.isnan(matrix).any():
+                matrix_avgs = getattr(np, 'nan' + sort_using)(matrix, axis=1)
+            else:
+                matrix_avgs = getattr(np, sort_using)(matrix, axis=1)
         else:
             sys.exit("{} is an unsupported sorting method".format(sort_using))
 
-        # order per group
+        # order per group. The rows of each group are rearranged in place,
+        # thus at most a copy of the largest group is needed
         _sorted_regions = []
-        _sorted_matrix = []
         for idx in range(len(self.group_labels)):
             start = self.group_boundaries[idx]
             end = self.group_boundaries[idx + 1]
             order = matrix_avgs[start:end].argsort()
             if sort_method == 'descend':
                 order = order[::-1]
-            _sorted_matrix.append(self.matrix[start:end, :][order, :])
+            self.matrix[start:end, :] = self.matrix[start:end, :][order, :]
             # sort the regions
             _reg = self.regions[start:end]
             for idx in order:
                 _sorted_regions.append(_reg[idx])
 
-        self.matrix = np.vstack(_sorted_matrix)
         self.regions = _sorted_regions
         self.set_sorting_method(sort_method, sort_using)
 
@@ -1276,7 +1307,13 @@ class _matrix(object):
         if method == 'kmeans':
             from scipy.cluster.vq import vq, kmeans
 
-            centroids, _ = kmeans(matrix_to_cluster, k)
+            # for large matrices the centroids are estimated from a random
+            # subset of the regions, all regions are then assigned below
+            if matrix_to_cluster.shape[0] > 50000:
+                subset = np.sort(np.random.RandomState(0).choice(matrix_to_cluster.shape[0], 50000, replace=False))
+                centroids, _ = kmeans(matrix_to_cluster[subset, :], k)
+            else:
+                centroids, _ = kmeans(matrix_to_cluster, k)
             # order the centroids in an attempt to
             # get the same cluster order
             cluster_labels, _ = vq(matrix_to_cluster, centroids)
@@ -1284,8 +1321,24 @@ class _matrix(object):
         if method == 'hierarchical':
             # normally too slow for large data sets
             from scipy.cluster.hierarchy import fcluster, linkage
-            Z = linkage(matrix_to_cluster, method='ward', metric='euclidean')
-            cluster_labels = fcluster(Z, k, criterion='maxclust')
+            if matrix_to_cluster.shape[0] > 20000:
+                # the distances between all regions of large matrices do not
+                # fit in memory, thus a random subset of the regions is clustered
+                # and the other regions are assigned to the closest cluster mean.
+                # The subset is seeded, so the clustering stays deterministic
+                from scipy.cluster.vq import vq
+                subset = np.sort(np.random.RandomState(0).choice(matrix_to_cluster.shape[0], 20000, replace=False))
+                Z = linkage(matrix_to_cluster[subset, :], method='ward', metric='euclidean')
+                subset_labels = fcluster(Z, k, criterion='maxclust')
+                labels = np.unique(subset_labels)
+                centroids = np.array([matrix_to_cluster[subset[subset_labels == label], :].mean(axis=0)
+                                      for label in labels])
+                closest, _ = vq(matrix_to_cluster, centroids)
+                cluster_labels = labels[closest]
+                cluster_labels[subset] = subset_labels
+            else:
+                Z = linkage(matrix_to_cluster, method='ward', metric='euclidean')
+                cluster_labels = fcluster(Z, k, criterion='maxclust')
             # hierarchical clustering labels from 1 .. k
             # while k-means labels 0 .. k -1
             # Thus, for consistency, we subtract 1
@@ -1324,17 +1377,20 @@ class _matrix(object):
 
     def computeSilhouette(self, k):
         if k > 1:
-            from scipy.spatial.distance import pdist, squareform
+            from scipy.spatial.distance import cdist
 
             silhouette = np.repeat(0.0, self.group_boundaries[-1])
             groupSizes = np.subtract(self.group_boundaries[1:], self.group_boundaries[:-1])
             labels = np.repeat(np.arange(k), groupSizes)
 
-            d = pdist(self.matrix)
-            d2 = squareform(d)
-            np.fill_diagonal(d2, np.nan)  # This excludes the diagonal
-            for idx in range(len(labels)):
-                silhouette[idx] = computeSilhouetteScore(d2, idx, labels)
+            # the distances are computed for blocks of rows, rather than as a
+            # square matrix, to keep the memory use linear in the number of rows
+            blockSize = max(1, 2 ** 24 // len(labels))
+            for start in range(0, len(labels), blockSize):
+                end = min(start + blockSize, len(labels))
+                d = cdist(self.matrix[start:end, :], self.matrix)
+                d[np.arange(end - start), np.arange(start, end)] = np.nan  # This excludes the diagonal
+                silhouette[start:end] = computeSilhouetteScores(d, labels[start:end], labels, k)
             sys.stderr.write("The average silhouette score is: {}\n".format(np.mean(silhouette)))
             self.silhouette = silhouette
 
@@ -1355,14 +1411,23 @@ class _matrix(object):
         to_keep = np.array(to_keep)
         self.group_boundaries = [len(to_keep[to_keep < x]) for x in self.group_boundaries]
 
-    def flatten(self):
+    def flatten(self, max_values=None):
         """
         flatten and remove nans from matrix. Useful
         to get max and mins from matrix.
 
+        :param max_values: if set and the matrix is larger, only a random
+            (but reproducible) sample of max_values entries is returned.
+            Percentiles computed on it are thus approximate.
         :return flattened matrix
         """
-        matrix_flatten = np.asarray(self.matrix.flatten())
+        # ravel() avoids the copy made by flatten() when possible
+        matrix_flatten = np.asarray(self.matrix).ravel()
+        if max_values is not None and matrix_flatten.size > max_values:
+            rng = np.random.RandomState(0)
+            matrix_flatten = matrix_flatten[rng.randint(0, matrix_flatten.size, max_values)]
+            if np.all(np.isnan(matrix_flatten)):
+                return self.flatten()
         # nans are removed from the flattened array
         matrix_flatten = matrix_flatten[~np.isnan(matrix_flatten)]
         if len(matrix_flatten) == 0:
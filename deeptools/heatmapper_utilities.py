@@ -1,3 +1,4 @@
+import warnings
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -10,6 +11,42 @@ import plotly.graph_objs as go
 old_settings = np.seterr(all='ignore')
 
 
+def summarize_columns(ma, average_type):
+    """
+    Summarizes each column of the matrix using the `average_type`
+    numpy.ma function (sum mean median min max std), ignoring masked
+    and nan values.
+
+    np.ma.median sorts every column, thus the median is instead selected
+    with np.median (or np.nanmedian if there are missing values), which
+    use np.partition.
+
+    Examples
+    --------
+
+    >>> matrix = np.ma.masked_invalid([[1, 2, np.nan], [3, 6, np.nan], [8, 4, np.nan]])
+    >>> summarize_columns(matrix, 'median').tolist()
+    [3.0, 4.0, None]
+    >>> summarize_columns(matrix[:2], 'mean').tolist()
+    [2.0, 4.0, None]
+    >>> summarize_columns(matrix.astype(np.float32), 'median').dtype
+    dtype('float32')
+    """
+    if average_type != 'median':
+        return np.ma.__getattribute__(average_type)(ma, axis=0)
+
+    # keep single precision matrices in single precision
+    values = np.ma.filled(np.ma.masked_invalid(ma).astype(np.result_type(ma.dtype, np.float32)), np.nan)
+    if np.isnan(values).any():
+        with warnings.catch_warnings():
+            # columns without any value are masked below
+            warnings.simplefilter('ignore', RuntimeWarning)
+            summary = np.nanmedian(values, axis=0)
+    else:
+        summary = np.median(values, axis=0)
+    return np.ma.masked_invalid(summary)
+
+
 def plot_single(ax, ma, average_type, color, label, plot_type='lines'):
     """
     Adds a line to the plot in the given ax using the specified method
@@ -63,7 +100,7 @@ def plot_single(ax, ma, average_type, color, label, plot_type='lines'):
 
 
     """
-    summary = np.ma.__getattribute__(average_type)(ma, axis=0)
+    summary = summarize_columns(ma, average_type)
     # only plot the average profiles without error regions
     x = np.arange(len(summary))
     if isinstance(color, np.ndarray):
@@ -93,7 +130,7 @@ def plot_single(ax, ma, average_type, color, label, plot_type='lines'):
 
 def plotly_single(ma, average_type, color, label, plot_type='line'):
     """A plotly version of plot_single. Returns a list of traces"""
-    summary = list(np.ma.__getattribute__(average_type)(ma, axis=0))
+    summary = list(summarize_columns(ma, average_type))
     x = list(np.arange(len(summary)))
     if isinstance(color, str):
         color = list(matplotlib.colors.to_rgb(color))
@@ -10,10 +10,14 @@ matplotlib.use('Agg')
 matplotlib.rcParams['pdf.fonttype'] = 42
 matplotlib.rcParams['svg.fonttype'] = 'none'
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure, SubplotParams
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.font_manager import FontProperties
 import matplotlib.gridspec as gridspec
 from matplotlib import ticker
+import concurrent.futures
 import copy
+import functools
 import sys
 import plotly.offline as py
 import plotly.graph_objs as go
@@ -60,6 +64,154 @@ def process_args(args=None):
     return args
 
 
+def partition_percentiles(values, q):
+    """
+    Linearly interpolated percentiles (as np.percentile) of a
+    1D array that contains no nans. Instead of sorting,
+    values is partitioned in place around the required ranks
+    using a single call to np.partition (introselect, O(N)).
+
+    >>> partition_percentiles(np.array([5., 1., 4., 2., 3.]), [0.0, 50.0, 75.0, 100.0])
+    array([1., 3., 4., 5.])
+    >>> partition_percentiles(np.array([1., 2.]), [50.0])
+    array([1.5])
+    """
+    last = len(values) - 1
+    pos = np.asarray(q, dtype=float) / 100.0 * last
+    lower = np.floor(pos).astype(int)
+    upper = np.minimum(lower + 1, last)
+    values.partition(np.unique(np.concatenate([lower, upper])))
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+@functools.lru_cache(maxsize=32)
+def get_profile_colors(num_lines):
+    """
+    Returns the colors of the lines of the summary plots, taken
+    at regular intervals from the 'jet' color map. The colors are
+    cached, so the array is read only.
+    """
+    color_list = plt.get_cmap('jet')(np.arange(num_lines) / num_lines)
+    color_list.setflags(write=False)
+    return color_list
+
+
+def quantize_matrix(matrix, vmin, vmax, num_colors=256):
+    """
+    Clips the values of matrix to [vmin, vmax] and maps them
+    to the num_colors integer levels 0 .. num_colors - 1 (uint8).
+    Masked values (nans) remain masked.
+
+    The levels are the entries of a color map with num_colors colors
+    that matplotlib would look up for the values, thus showing them with
+    Normalize(0, num_colors - 1) gives the same colors.
+
+    >>> levels = quantize_matrix(np.ma.masked_invalid([[-1., 0., 0.5, 0.999, 1., 2., np.nan]]), 0., 1.)
+    >>> levels.dtype, levels.tolist()
+    (dtype('uint8'), [[0, 0, 128, 255, 255, 255, None]])
+    >>> quantize_matrix(np.ma.masked_invalid([[0., 0.19, 0.2, 0.5, 0.79, 0.8, 1.]]), 0., 1., num_colors=5).tolist()
+    [[0, 0, 1, 2, 3, 4, 4]]
+    """
+    # a single float buffer is allocated and then updated in place,
+    # computing the values as matplotlib does, in single precision for float32
+    levels = np.subtract(np.ma.getdata(matrix), vmin, dtype=np.result_type(matrix.dtype, np.float32))
+    levels /= (vmax - vmin)
+    levels *= num_colors
+    # fmax also replaces nans by 0 to avoid invalid casts, they remain masked
+    np.fmax(levels, 0, out=levels)
+    np.minimum(levels, num_colors - 1, out=levels)
+    out = np.empty(levels.shape, dtype=np.uint8)
+    np.copyto(out, levels, casting='unsafe')
+    return np.ma.masked_array(out, mask=np.ma.getmaskarray(matrix))
+
+
+def downsample_rows(matrix, stride):
+    """
+    Reduces the number of rows of a (masked) matrix by replacing each
+    block of stride consecutive rows by its mean, ignoring masked
+    values. Trailing rows that do not fill a whole block are averaged
+    into a last, smaller block.
+
+    >>> downsample_rows(np.ma.masked_invalid([[1., 2.], [3., np.nan], [5., 6.], [7., 8.], [9., 9.]]), 2).tolist()
+    [[2.0, 2.0], [6.0, 7.0], [9.0, 9.0]]
+    """
+    rows, cols = matrix.shape
+    num_blocks = rows // stride
+    matrix = np.ma.masked_invalid(matrix)
+    blocks = matrix[:num_blocks * stride].reshape(num_blocks, stride, cols).mean(axis=1)
+    if num_blocks * stride < rows:
+        remainder = matrix[num_blocks * stride:].mean(axis=0).reshape(1, cols)
+        blocks = np.ma.concatenate([blocks, remainder])
+    # np.ma.mean divides by integer counts, which promotes float32 to float64
+    return blocks.astype(np.result_type(matrix.dtype, np.float32), copy=False)
+
+
+def prepare_heatmap_image(hm, group, sample, vmin, vmax, target_rows, interpolation_method, num_colors=256):
+    """
+    returns the image shown in the heatmap of the group and sample, the
+    shape of its sub-matrix and the value range of the image.
+
+    heatmaps with many more rows than pixels are averaged down to the
+    resolution of the image beforehand, as otherwise matplotlib has to
+    resample all rows. The values are clipped before they are averaged,
+    so that outliers do not pull their whole block to the limits.
+
+    Missing vmin and vmax values are taken from the full heatmap itself, like imshow
+    would do. If both are known and the color map has at most 256 colors
+    (num_colors), the values are clipped and quantized to its uint8 levels,
+    which are much cheaper to resample and normalize than float values.
+
+    Otherwise, if np.clip is not used, then values of the matrix that exceed the zmax limit are
+    highlighted. Usually, a significant amount of pixels are equal or above the zmax and
+    the default behaviour produces images full of large highlighted dots.
+    If interpolation='nearest' is used, this has no effect, so the copy is skipped
+    """
+    sub_matrix = hm.matrix.get_matrix(group, sample)['matrix']
+    rows, cols = sub_matrix.shape
+    clip_bounds = vmin is not None or vmax is not None
+
+    if (vmin is None or vmax is None) and sub_matrix.count():
+        # as imshow would autoscale the heatmap, after it is clipped below
+        low, high = sub_matrix.min(), sub_matrix.max()
+        if clip_bounds:
+            low, high = np.clip([low, high], vmin, vmax)
+        if vmin is None:
+            vmin = low
+        if vmax is None:
+            vmax = high
+
+    if rows > 4 * target_rows:
+        if clip_bounds:
+            sub_matrix = np.clip(sub_matrix, vmin, vmax)
+        sub_matrix = downsample_rows(sub_matrix, rows // target_rows)
+
+    # get_matrix, downsample_rows, quantize_matrix and np.clip all return new
+    # C-contiguous arrays, so imshow can resample them without another copy
+    if num_colors <= 256 and vmin is not None and vmax is not None and vmax > vmin:
+        image = quantize_matrix(sub_matrix, vmin, vmax, num_colors)
+    elif interpolation_method != 'nearest':
+        image = np.clip(sub_matrix, vmin, vmax)
+    else:
+        image = sub_matrix
+    return image, rows, cols, vmin, vmax
+
+
+def get_region_length(region):
+    """
+    Returns the length of a region, either given as a dictionary
+    with start and end, or as a matrix region whose second element
+    is the list of (start, end) exons.
+
+    >>> get_region_length({'start': 10, 'end': 30})
+    20
+    >>> get_region_length(['chr1', [(0, 10), (20, 25)], 'name'])
+    15
+    """
+    if isinstance(region, dict):
+        return region['end'] - region['start']
+    return sum(x[1] - x[0] for x in region[1])
+
+
 def prepare_layout(hm_matrix, heatmapsize, showSummaryPlot, showColorbar, perGroup, colorbar_position):
     """
     prepare the plot layout
@@ -116,19 +268,23 @@ def prepare_layout(hm_matrix, heatmapsize, showSummaryPlot, showColorbar, perGro
     return grids
 
 
+def getProfileSubGrid(grids, iterNum, wspace, hspace, colorbar_position):
+    """
+    Returns a grid for the profile plots in the top row of grids with the given spacing, which is used to mimic a tight layout
+    """
+    if colorbar_position == 'side':
+        return gridspec.GridSpecFromSubplotSpec(1, iterNum, subplot_spec=grids[0, :-1], wspace=wspace, hspace=hspace)
+    return gridspec.GridSpecFromSubplotSpec(1, iterNum, subplot_spec=grids[0, :], wspace=wspace, hspace=hspace)
+
+
 def addProfilePlot(hm, plt, fig, grids, iterNum, iterNum2, perGroup, averageType, plot_type, yAxisLabel, color_list, yMin, yMax, wspace, hspace, colorbar_position, label_rotation=0.0):
     """
     A function to add profile plots to the given figure, possibly in a custom grid subplot which mimics a tight layout (if wspace and hspace are not None)
     """
     if wspace is not None and hspace is not None:
-        if colorbar_position == 'side':
-            gridsSub = gridspec.GridSpecFromSubplotSpec(1, iterNum, subplot_spec=grids[0, :-1], wspace=wspace, hspace=hspace)
-        else:
-            gridsSub = gridspec.GridSpecFromSubplotSpec(1, iterNum, subplot_spec=grids[0, :], wspace=wspace, hspace=hspace)
+        gridsSub = getProfileSubGrid(grids, iterNum, wspace, hspace, colorbar_position)
 
     ax_list = []
-    globalYmin = np.inf
-    globalYmax = -np.inf
     for sample_id in range(iterNum):
         if perGroup:
             title = hm.matrix.group_labels[sample_id]
@@ -164,9 +320,10 @@ def addProfilePlot(hm, plt, fig, grids, iterNum, iterNum2, perGroup, averageType
         if sample_id == 0 and yAxisLabel != '':
             ax_profile.set_ylabel(yAxisLabel)
         xticks, xtickslabel = hm.getTicks(tickIdx)
-        if np.ceil(max(xticks)) != float(sub_matrix['matrix'].shape[1] - 1):
-            tickscale = float(sub_matrix['matrix'].shape[1] - 1) / max(xticks)
-            xticks_use = [x * tickscale for x in xticks]
+        xticks = np.asarray(xticks)
+        if np.ceil(xticks.max()) != float(sub_matrix['matrix'].shape[1] - 1):
+            tickscale = float(sub_matrix['matrix'].shape[1] - 1) / xticks.max()
+            xticks_use = xticks * tickscale
             ax_profile.axes.set_xticks(xticks_use)
         else:
             ax_profile.axes.set_xticks(xticks)
@@ -180,8 +337,11 @@ def addProfilePlot(hm, plt, fig, grids, iterNum, iterNum2, perGroup, averageType
         ticks[0].label1.set_horizontalalignment('left')
         ticks[-1].label1.set_horizontalalignment('right')
 
-        globalYmin = min(np.float64(globalYmin), ax_profile.get_ylim()[0])
-        globalYmax = max(globalYmax, ax_profile.get_ylim()[1])
+    # the common y limits are those of the autoscaled profiles (including their
+    # margins), each axis is autoscaled only once, after all lines are drawn
+    ylims = np.array([ax_profile.get_ylim() for ax_profile in ax_list], dtype=np.float64)
+    globalYmin = ylims[:, 0].min()
+    globalYmax = ylims[:, 1].max()
 
     # It turns out that set_ylim only takes np.float64s
     for sample_id, subplot in enumerate(ax_list):
@@ -295,57 +455,55 @@ def plotlyMatrix(hm,
 
     # Add the heatmap
     dataHeatmap = []
-    zMinLocal = np.inf
-    zMaxLocal = -np.inf
     heatmapWidth = 1. / nCols
     heatmapSideBuffer = 0.0
     if nCols > 1:
         heatmapWidth = .9 / nCols
         heatmapSideBuffer = 0.1 / (nCols - 1)
     heatmapHeight = 1.0 - profileHeight - profileBottomBuffer
+    # the number of rows of each heatmap
+    group_sizes = np.diff(hm.matrix.group_boundaries)
+    # the region names, used as y labels, are extracted only once
+    region_names = np.array([x[2] for x in hm.matrix.regions], dtype=object)
 
     for i in range(nCols):
         xanchor = 'x{}'.format(xAxisN)
         xBase = i * (heatmapSideBuffer + heatmapWidth)
 
+        # Fetch the sub-matrices of this column only once
+        if perGroup:
+            mats = [hm.matrix.get_matrix(i, j) for j in range(nRows)]
+        else:
+            mats = [hm.matrix.get_matrix(j, i) for j in range(nRows)]
+
         # Determine the height of each heatmap, they have no buffer
-        lengths = [0.0]
-        for j in range(nRows):
-            if perGroup:
-                mat = hm.matrix.get_matrix(i, j)
-            else:
-                mat = hm.matrix.get_matrix(j, i)
-            lengths.append(mat['matrix'].shape[0])
+        if perGroup:
+            lengths = [0.0] + [group_sizes[i]] * nRows
+        else:
+            lengths = [0.0] + group_sizes.tolist()
         fractionalHeights = heatmapHeight * np.cumsum(lengths).astype(float) / np.sum(lengths).astype(float)
         xDomain = [xBase, xBase + heatmapWidth]
-        fig['layout']['xaxis{}'.format(xAxisN)] = dict(domain=xDomain, anchor='free', position=0.0, range=[0, mat['matrix'].shape[1]], tickmode='array', tickvals=xTicks, ticktext=xTicksLabels, title=xAxisLabel)
+        fig['layout']['xaxis{}'.format(xAxisN)] = dict(domain=xDomain, anchor='free', position=0.0, range=[0, mats[-1]['matrix'].shape[1]], tickmode='array', tickvals=xTicks, ticktext=xTicksLabels, title=xAxisLabel)
 
         # Start adding the heatmaps
-        for j in range(nRows):
+        for j, mat in enumerate(mats):
             if perGroup:
-                mat = hm.matrix.get_matrix(i, j)
                 label = mat['sample']
                 start = hm.matrix.group_boundaries[i]
                 end = hm.matrix.group_boundaries[i + 1]
             else:
-                mat = hm.matrix.get_matrix(j, i)
                 label = mat['group']
                 start = hm.matrix.group_boundaries[j]
                 end = hm.matrix.group_boundaries[j + 1]
-            regs = hm.matrix.regions[start:end]
-            regs = [x[2] for x in regs]
+            regs = region_names[start:end].tolist()
             yanchor = 'y{}'.format(yAxisN)
             yDomain = [heatmapHeight - fractionalHeights[j + 1], heatmapHeight - fractionalHeights[j]]
             visible = False
             if i == 0:
                 visible = True
             fig['layout']['yaxis{}'.format(yAxisN)] = dict(domain=yDomain, anchor=xanchor, visible=visible, title=label, tickmode='array', tickvals=[], ticktext=[])
-            if np.min(mat['matrix']) < zMinLocal:
-                zMinLocal = np.min(mat['matrix'])
-            if np.max(mat['matrix']) < zMaxLocal:
-                zMaxLocal = np.max(mat['matrix'])
 
-            trace = go.Heatmap(z=np.flipud(mat['matrix']),
+            trace = go.Heatmap(z=mat['matrix'][::-1],
                                y=regs[::-1],
                                xaxis=xanchor,
                                yaxis=yanchor,
@@ -360,19 +518,24 @@ def plotlyMatrix(hm,
         dataHeatmap[-1].update(showscale=True)
         dataHeatmap[-1]['colorbar'].update(len=heatmapHeight, y=0, yanchor='bottom', ypad=0.0)
 
-    # Adjust z bounds and colorscale
+    # Adjust z bounds and colorscale. The heatmaps cover the whole matrix, so
+    # missing bounds are taken from its range, which is only scanned if needed
+    zMinUse = zMin[0]
+    zMaxUse = zMax[0]
+    if zMinUse is None or zMaxUse is None:
+        matrix_flatten = hm.matrix.flatten()
+        if zMinUse is None:
+            zMinUse = np.min(matrix_flatten)
+        if zMaxUse is None:
+            zMaxUse = np.max(matrix_flatten)
     for trace in dataHeatmap:
-        zMinUse = zMinLocal
-        zMaxUse = zMaxLocal
-        if zMin[0] is not None:
-            zMinUse = zMin[0]
-        if zMax[0] is not None:
-            zMaxUse = zMax[0]
         trace.update(zmin=zMinUse, zmax=zMaxUse, colorscale=convertCmap(cmap[0], vmin=zMinUse, vmax=zMaxUse))
 
     dataSummary.extend(dataHeatmap)
     fig.add_traces(dataSummary)
     fig['layout']['annotations'] = annos
+    # the heatmaps are passed as numpy arrays, which plotly (>= 5) encodes
+    # with orjson, rather than the json module, whenever it is installed
     py.plot(fig, filename=outFilename, auto_open=False)
 
 
@@ -403,20 +566,25 @@ def plotMatrix(hm, outFileName,
     hm.startLabel = startLabel
     hm.endLabel = endLabel
 
-    matrix_flatten = None
-    if zMin is None:
-        matrix_flatten = hm.matrix.flatten()
-        # try to avoid outliers by using np.percentile
-        zMin = np.percentile(matrix_flatten, 1.0)
-        if np.isnan(zMin):
-            zMin = [None]
-        else:
-            zMin = [zMin]  # convert to list to support multiple entries
-    elif 'auto' in zMin:
-        matrix_flatten = hm.matrix.flatten()
-        auto_min = np.percentile(matrix_flatten, 1.0)
+    auto_min = None
+    auto_max = None
+    if zMin is None or zMax is None or 'auto' in zMin or 'auto' in zMax:
+        # flatten() returns a fresh copy without nans. For very large
+        # matrices a random sample of 1e6 values is used, whose
+        # percentiles are approximate, but well below the color resolution
+        matrix_flatten = hm.matrix.flatten(max_values=1000000)
+        # try to avoid outliers by using the 1st and 98th percentiles.
+        # Both are selected in a single in-place partition of the copy
+        auto_min, auto_max = partition_percentiles(matrix_flatten, [1.0, 98.0])
         if np.isnan(auto_min):
             auto_min = None
+        if np.isnan(auto_max):
+            auto_max = None
+        del matrix_flatten
+
+    if zMin is None:
+        zMin = [auto_min]  # convert to list to support multiple entries
+    elif 'auto' in zMin:
         new_mins = [float(x) if x != 'auto' else auto_min for x in zMin]
         zMin = new_mins
     else:
@@ -424,19 +592,11 @@ def plotMatrix(hm, outFileName,
         zMin = new_mins
 
     if zMax is None:
-        if matrix_flatten is None:
-            matrix_flatten = hm.matrix.flatten()
-        # try to avoid outliers by using np.percentile
-        zMax = np.percentile(matrix_flatten, 98.0)
-        if np.isnan(zMax) or zMax <= zMin[0]:
+        if auto_max is None or (zMin[0] is not None and auto_max <= zMin[0]):
             zMax = [None]
         else:
-            zMax = [zMax]
+            zMax = [auto_max]
     elif 'auto' in zMax:
-        matrix_flatten = hm.matrix.flatten()
-        auto_max = np.percentile(matrix_flatten, 98.0)
-        if np.isnan(auto_max):
-            auto_max = None
         new_maxs = [float(x) if x != 'auto' else auto_max for x in zMax]
         zMax = new_maxs
     else:
@@ -519,16 +679,23 @@ def plotMatrix(hm, outFileName,
         else:
             total_figwidth += 1 / 2.54
 
-    fig = plt.figure(figsize=(total_figwidth, figheight))
+    # the figure is not registered with pyplot, and is drawn with the Agg canvas.
+    # The spacing is set before any axes are added, so they are placed only once
+    if box_around_heatmaps:
+        subplotpars = SubplotParams(wspace=0.10, hspace=0.025, top=0.85, bottom=0, left=0.04, right=0.96)
+    else:
+        #  When no box is plotted the space between heatmaps is reduced
+        subplotpars = SubplotParams(wspace=0.05, hspace=0.01, top=0.85, bottom=0, left=0.04, right=0.96)
+    fig = Figure(figsize=(total_figwidth, figheight), subplotpars=subplotpars)
+    FigureCanvasAgg(fig)
     fig.suptitle(plotTitle, y=1 - (0.06 / figheight))
 
     # color map for the summary plot (profile) on top of the heatmap
-    cmap_plot = plt.get_cmap('jet')
     numgroups = hm.matrix.get_num_groups()
     if perGroup:
-        color_list = cmap_plot(np.arange(hm.matrix.get_num_samples()) / hm.matrix.get_num_samples())
+        color_list = get_profile_colors(hm.matrix.get_num_samples())
     else:
-        color_list = cmap_plot(np.arange(numgroups) / numgroups)
+        color_list = get_profile_colors(numgroups)
     alpha = colorMapDict['alpha']
     if image_format == 'plotly':
         return plotlyMatrix(hm,
@@ -546,30 +713,24 @@ def plotMatrix(hm, outFileName,
     # and is sorted by region length. If this is
     # the case, prepare the data to plot a border at the regions end
     regions_length_in_bins = [None] * len(hm.parameters['upstream'])
-    if hm.matrix.sort_using == 'region_length' and hm.matrix.sort_method != 'no':
+    if hm.matrix.sort_using == 'region_length' and hm.matrix.sort_method != 'no' and \
+            any(ref_point is not None for ref_point in hm.parameters['ref point']):
+        # the region lengths are the same for all samples, thus
+        # they are computed only once per group
+        _regions_len = []
+        for _group in hm.matrix.get_regions():
+            _regions_len.append(np.fromiter((get_region_length(ind_reg) for ind_reg in _group),
+                                            dtype=np.float64, count=len(_group)))
+
         for idx in range(len(hm.parameters['upstream'])):
-            if hm.parameters['ref point'][idx] is None:
-                regions_length_in_bins[idx] = None
-                continue
-
-            _regions = hm.matrix.get_regions()
-            foo = []
-            for _group in _regions:
-                _reg_len = []
-                for ind_reg in _group:
-                    if isinstance(ind_reg, dict):
-                        _len = ind_reg['end'] - ind_reg['start']
-                    else:
-                        _len = sum([x[1] - x[0] for x in ind_reg[1]])
-                    if hm.parameters['ref point'][idx] == 'TSS':
-                        _reg_len.append((hm.parameters['upstream'][idx] + _len) / hm.parameters['bin size'][idx])
-                    elif hm.parameters['ref point'][idx] == 'center':
-                        _len *= 0.5
-                        _reg_len.append((hm.parameters['upstream'][idx] + _len) / hm.parameters['bin size'][idx])
-                    elif hm.parameters['ref point'][idx] == 'TES':
-                        _reg_len.append((hm.parameters['upstream'][idx] - _len) / hm.parameters['bin size'][idx])
-                foo.append(_reg_len)
-            regions_length_in_bins[idx] = foo
+            upstream = hm.parameters['upstream'][idx]
+            bin_size = hm.parameters['bin size'][idx]
+            if hm.parameters['ref point'][idx] == 'TSS':
+                regions_length_in_bins[idx] = [(upstream + _len) / bin_size for _len in _regions_len]
+            elif hm.parameters['ref point'][idx] == 'center':
+                regions_length_in_bins[idx] = [(upstream + 0.5 * _len) / bin_size for _len in _regions_len]
+            elif hm.parameters['ref point'][idx] == 'TES':
+                regions_length_in_bins[idx] = [(upstream - _len) / bin_size for _len in _regions_len]
 
     # plot the profiles on top of the heatmaps
     if showSummaryPlot:
@@ -581,52 +742,85 @@ def plotMatrix(hm, outFileName,
             iterNum2 = numgroups
         ax_list = addProfilePlot(hm, plt, fig, grids, iterNum, iterNum2, perGroup, averageType, plot_type, yAxisLabel, color_list, yMin, yMax, None, None, colorbar_position, label_rotation)
         if len(yMin) > 1 or len(yMax) > 1:
-            # replot with a tight layout
+            # move the profiles to a grid mimicking a tight layout. The
+            # axes are only repositioned, so the profiles are not computed again
             import matplotlib.tight_layout as tl
             specList = tl.get_subplotspec_list(fig.axes, grid_spec=grids)
             renderer = tl.get_renderer(fig)
             kwargs = tl.get_tight_layout_figure(fig, fig.axes, specList, renderer, pad=1.08)
 
-            for ax in ax_list:
-                fig.delaxes(ax)
-
-            ax_list = addProfilePlot(hm, plt, fig, grids, iterNum, iterNum2, perGroup, averageType, plot_type, yAxisLabel, color_list, yMin, yMax, kwargs['wspace'], kwargs['hspace'], colorbar_position, label_rotation)
+            gridsSub = getProfileSubGrid(grids, iterNum, kwargs['wspace'], kwargs['hspace'], colorbar_position)
+            for sample_id, ax_profile in enumerate(ax_list):
+                ax_profile.set_subplotspec(gridsSub[0, sample_id])
+                ax_profile.set_position(gridsSub[0, sample_id].get_position(fig))
 
         if legend_location != 'none':
             ax_list[-1].legend(loc=legend_location.replace('-', ' '), ncol=1, prop=fontP,
                                frameon=False, markerscale=0.5)
 
+    # all heatmap axes are created in one pass, in the order in which they
+    # are drawn, before any image is added to the figure
+    row_offset = 2 if showSummaryPlot else 0  # plot + spacer
+    heatmap_axes = {}
+    for sample in range(hm.matrix.get_num_samples()):
+        for group in range(numgroups):
+            if perGroup:
+                heatmap_axes[sample, group] = fig.add_subplot(grids[sample + row_offset, group])
+            else:
+                heatmap_axes[sample, group] = fig.add_subplot(grids[group + row_offset, sample])
+
+    # number of pixel rows available for each heatmap, which only gets
+    # its share of the heatmap height
+    target_rows = {}
+    for key, ax in heatmap_axes.items():
+        target_rows[key] = max(1, int(ax.get_position().height * fig.get_figheight() * dpi))
+
+    # the quantized heatmaps share one norm per number of colors, and the colorbars
+    # one norm per value range, instead of creating a norm for every heatmap
+    level_norms = {}
+    value_norms = {}
+
+    # if the number of rows is too large, then the 'nearest' method simply
+    # drops rows. A better solution is to relate the threshold to the DPI of the image
+    if interpolation_method == 'auto':
+        if hm.matrix.group_boundaries[1] - hm.matrix.group_boundaries[0] >= 1000:
+            interpolation_method = 'bilinear'
+        else:
+            interpolation_method = 'nearest'
+
+    # the images of the heatmaps are prepared in threads, since numpy
+    # releases the GIL while copying, averaging and quantizing the values
+    heatmap_images = {}
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for sample in range(hm.matrix.get_num_samples()):
+            for group in range(numgroups):
+                bounds_idx = group if perGroup else sample
+                heatmap_images[sample, group] = executor.submit(prepare_heatmap_image, hm, group, sample,
+                                                                zMin[bounds_idx % len(zMin)],
+                                                                zMax[bounds_idx % len(zMax)],
+                                                                target_rows[sample, group], interpolation_method,
+                                                                num_colors=cmap[bounds_idx % len(cmap)].N)
+
     first_group = 0  # helper variable to place the title per sample/group
     for sample in range(hm.matrix.get_num_samples()):
-        sample_idx = sample
         for group in range(numgroups):
             group_idx = group
-            # add the respective profile to the
-            # summary plot
-            sub_matrix = hm.matrix.get_matrix(group, sample)
             if showSummaryPlot:
-                if perGroup:
-                    sample_idx = sample + 2  # plot + spacer
-                else:
+                if not perGroup:
                     group += 2  # plot + spacer
                 first_group = 1
 
+            ax = heatmap_axes[sample, group_idx]
             if perGroup:
-                ax = fig.add_subplot(grids[sample_idx, group])
                 # the remainder (%) is used to iterate
                 # over the available color maps (cmap).
                 # if the user only provided, lets say two
                 # and there are 10 groups, colormaps they are reused every
                 # two groups.
                 cmap_idx = group_idx % len(cmap)
-                zmin_idx = group_idx % len(zMin)
-                zmax_idx = group_idx % len(zMax)
             else:
-                ax = fig.add_subplot(grids[group, sample])
                 # see above for the use of '%'
                 cmap_idx = sample % len(cmap)
-                zmin_idx = sample % len(zMin)
-                zmax_idx = sample % len(zMax)
 
             if group == first_group and not showSummaryPlot and not perGroup:
                 title = hm.matrix.sample_labels[sample]
@@ -638,29 +832,38 @@ def plotMatrix(hm, outFileName,
                 ax.spines['right'].set_visible(False)
                 ax.spines['bottom'].set_visible(False)
                 ax.spines['left'].set_visible(False)
-            rows, cols = sub_matrix['matrix'].shape
-            # if the number of rows is too large, then the 'nearest' method simply
-            # drops rows. A better solution is to relate the threshold to the DPI of the image
-            if interpolation_method == 'auto':
-                if rows >= 1000:
-                    interpolation_method = 'bilinear'
-                else:
-                    interpolation_method = 'nearest'
-
-            # if np.clip is not used, then values of the matrix that exceed the zmax limit are
-            # highlighted. Usually, a significant amount of pixels are equal or above the zmax and
-            # the default behaviour produces images full of large highlighted dots.
-            # If interpolation='nearest' is used, this has no effect
-            sub_matrix['matrix'] = np.clip(sub_matrix['matrix'], zMin[zmin_idx], zMax[zmax_idx])
-            img = ax.imshow(sub_matrix['matrix'],
-                            aspect='auto',
-                            interpolation=interpolation_method,
-                            origin='upper',
-                            vmin=zMin[zmin_idx],
-                            vmax=zMax[zmax_idx],
-                            cmap=cmap[cmap_idx],
-                            alpha=alpha,
-                            extent=[0, cols, rows, 0])
+
+            # the extent keeps the original rows of downsampled heatmaps
+            image, rows, cols, vmin, vmax = heatmap_images[sample, group_idx].result()
+            if image.dtype == np.uint8:  # quantized
+                num_colors = cmap[cmap_idx].N
+                if num_colors not in level_norms:
+                    level_norms[num_colors] = matplotlib.colors.Normalize(vmin=0, vmax=num_colors - 1)
+                img = ax.imshow(image,
+                                aspect='auto',
+                                interpolation=interpolation_method,
+                                origin='upper',
+                                norm=level_norms[num_colors],
+                                cmap=cmap[cmap_idx],
+                                alpha=alpha,
+                                extent=[0, cols, rows, 0])
+                # the colorbar has to show the original values
+                if (vmin, vmax) not in value_norms:
+                    value_norms[vmin, vmax] = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
+                cbar_mappable = matplotlib.cm.ScalarMappable(norm=value_norms[vmin, vmax],
+                                                             cmap=cmap[cmap_idx])
+            else:
+                img = ax.imshow(image,
+                                aspect='auto',
+                                interpolation=interpolation_method,
+                                origin='upper',
+                                vmin=vmin,
+                                vmax=vmax,
+                                cmap=cmap[cmap_idx],
+                                alpha=alpha,
+                                extent=[0, cols, rows, 0])
+                # the colorbar only needs the (autoscaled) norm of the image, not its data
+                cbar_mappable = matplotlib.cm.ScalarMappable(norm=img.norm, cmap=img.cmap)
             img.set_rasterized(True)
             # plot border at the end of the regions
             # if ordered by length
@@ -675,7 +878,7 @@ def plotMatrix(hm, outFileName,
                 ax.set_ylim(y_lim)
 
             if perGroup:
-                ax.axes.set_xlabel(sub_matrix['group'])
+                ax.axes.set_xlabel(hm.matrix.group_labels[group_idx])
                 if sample < hm.matrix.get_num_samples() - 1:
                     ax.axes.get_xaxis().set_visible(False)
             else:
@@ -683,17 +886,17 @@ def plotMatrix(hm, outFileName,
                 ax.axes.set_xlabel(xAxisLabel)
             ax.axes.set_yticks([])
             if perGroup and group == 0:
-                ax.axes.set_ylabel(sub_matrix['sample'])
+                ax.axes.set_ylabel(hm.matrix.sample_labels[sample])
             elif not perGroup and sample == 0:
-                ax.axes.set_ylabel(sub_matrix['group'])
+                ax.axes.set_ylabel(hm.matrix.group_labels[group_idx])
 
             # Plot vertical lines at tick marks if desired
             if linesAtTickMarks:
                 xticks_heat, xtickslabel_heat = hm.getTicks(sample)
-                xticks_heat = [x + 0.5 for x in xticks_heat]  # There's an offset of 0.5 compared to the profile plot
-                if np.ceil(max(xticks_heat)) != float(sub_matrix['matrix'].shape[1]):
-                    tickscale = float(sub_matrix['matrix'].shape[1]) / max(xticks_heat)
-                    xticks_heat_use = [x * tickscale for x in xticks_heat]
+                xticks_heat = np.asarray(xticks_heat) + 0.5  # There's an offset of 0.5 compared to the profile plot
+                if np.ceil(xticks_heat.max()) != float(cols):
+                    tickscale = float(cols) / xticks_heat.max()
+                    xticks_heat_use = xticks_heat * tickscale
                 else:
                     xticks_heat_use = xticks_heat
                 for x in xticks_heat_use:
@@ -706,10 +909,10 @@ def plotMatrix(hm, outFileName,
                 # add xticks to the bottom heatmap (last group)
                 ax.axes.get_xaxis().set_visible(True)
                 xticks_heat, xtickslabel_heat = hm.getTicks(sample)
-                xticks_heat = [x + 0.5 for x in xticks_heat]  # There's an offset of 0.5 compared to the profile plot
-                if np.ceil(max(xticks_heat)) != float(sub_matrix['matrix'].shape[1]):
-                    tickscale = float(sub_matrix['matrix'].shape[1]) / max(xticks_heat)
-                    xticks_heat_use = [x * tickscale for x in xticks_heat]
+                xticks_heat = np.asarray(xticks_heat) + 0.5  # There's an offset of 0.5 compared to the profile plot
+                if np.ceil(xticks_heat.max()) != float(cols):
+                    tickscale = float(cols) / xticks_heat.max()
+                    xticks_heat_use = xticks_heat * tickscale
                     ax.axes.set_xticks(xticks_heat_use)
                 else:
                     ax.axes.set_xticks(xticks_heat)
@@ -735,7 +938,7 @@ def plotMatrix(hm, outFileName,
                         col = sample
                     ax = fig.add_subplot(grids[-1, col])
                     tick_locator = ticker.MaxNLocator(nbins=3)
-                    cbar = fig.colorbar(img, cax=ax, orientation='horizontal', ticks=tick_locator)
+                    cbar = fig.colorbar(cbar_mappable, cax=ax, orientation='horizontal', ticks=tick_locator, alpha=alpha)
                     labels = cbar.ax.get_xticklabels()
                     ticks = cbar.ax.get_xticks()
                     if ticks[0] == 0:
@@ -759,54 +962,60 @@ def plotMatrix(hm, outFileName,
             grid_start = 0
 
         ax = fig.add_subplot(grids[grid_start:, -1])
-        fig.colorbar(img, cax=ax)
-
-    if box_around_heatmaps:
-        plt.subplots_adjust(wspace=0.10, hspace=0.025, top=0.85, bottom=0, left=0.04, right=0.96)
-    else:
-        #  When no box is plotted the space between heatmaps is reduced
-        plt.subplots_adjust(wspace=0.05, hspace=0.01, top=0.85, bottom=0, left=0.04, right=0.96)
+        fig.colorbar(cbar_mappable, cax=ax, alpha=alpha)
 
-    plt.savefig(outFileName, bbox_inches='tight', pad_inches=0.1, dpi=dpi, format=image_format)
-    plt.close()
+    # png files are compressed with a lower level than the default (6), which
+    # is much faster to write for large heatmaps and only slightly larger
+    save_kwargs = {}
+    if image_format == 'png' or (image_format is None and outFileName.lower().endswith('.png')):
+        save_kwargs['pil_kwargs'] = {'compress_level': 3}
+    fig.savefig(outFileName, bbox_inches='tight', pad_inches=0.1, dpi=dpi, format=image_format, **save_kwargs)
 
 
 def mergeSmallGroups(matrixDict):
-    group_lengths = [len(x) for x in matrixDict.values()]
-    min_group_length = sum(group_lengths) * 0.01
+    """
+    merges groups with less than 1% of all the rows into the following
+    group, trailing small groups are merged together. Each merged group
+    is concatenated only once.
 
-    to_merge = []
-    i = 0
-    _mergedHeatMapDict = OrderedDict()
+    >>> merged = mergeSmallGroups(OrderedDict([('a', np.zeros((1, 2))), ('b', np.ones((200, 2))), ('c', np.ones((2, 2)))]))
+    >>> [(label, ma.shape) for label, ma in merged.items()]
+    [('a b', (201, 2)), ('c', (2, 2))]
+    """
+    group_lengths = np.fromiter((len(x) for x in matrixDict.values()), dtype=np.int64, count=len(matrixDict))
+    # merge small groups together
+    # otherwise visualization is impaired
+    is_large = group_lengths > group_lengths.sum() * 0.01
+    # each group is merged into the next large group, which closes the bin
+    bin_ids = np.cumsum(is_large) - is_large
 
-    for label, ma in matrixDict.items():
-        # merge small groups together
-        # otherwise visualization is impaired
-        if group_lengths[i] > min_group_length:
-            if len(to_merge):
-                to_merge.append(label)
-                new_label = " ".join(to_merge)
-                new_ma = np.concatenate([matrixDict[item]
-                                        for item in to_merge], axis=0)
-            else:
-                new_label = label
-                new_ma = matrixDict[label]
+    bins = OrderedDict()
+    for label, bin_id in zip(matrixDict.keys(), bin_ids.tolist()):
+        bins.setdefault(bin_id, []).append(label)
 
-            _mergedHeatMapDict[new_label] = new_ma
-            to_merge = []
-        else:
-            to_merge.append(label)
-        i += 1
-    if len(to_merge) > 1:
-        new_label = " ".join(to_merge)
-        new_ma = np.array()
-        for item in to_merge:
-            new_ma = np.concatenate([new_ma, matrixDict[item]])
-        _mergedHeatMapDict[new_label] = new_ma
+    _mergedHeatMapDict = OrderedDict()
+    for labels in bins.values():
+        _mergedHeatMapDict[" ".join(labels)] = concatenateRows([matrixDict[item] for item in labels])
 
     return _mergedHeatMapDict
 
 
+def concatenateRows(matrices):
+    """
+    stacks the rows of the matrices into a single, preallocated, array.
+    A single matrix is returned as is.
+    """
+    if len(matrices) == 1:
+        return matrices[0]
+    new_ma = np.empty((sum(len(ma) for ma in matrices), matrices[0].shape[1]),
+                      dtype=np.result_type(*matrices))
+    row = 0
+    for ma in matrices:
+        new_ma[row:row + len(ma)] = ma
+        row += len(ma)
+    return new_ma
+
+
 def main(args=None):
     args = process_args(args)
     hm = heatmapper.heatmapper()
@@ -826,9 +1035,9 @@ def main(args=None):
               "Please note that it might be very slow for large datasets.\n")
         hm.matrix.hmcluster(args.hclust, method='hierarchical', clustering_samples=args.clusterUsingSamples)
 
-    group_len_ratio = np.diff(hm.matrix.group_boundaries) / len(hm.matrix.regions)
-    if np.any(group_len_ratio < 5.0 / 1000):
-        problem = np.flatnonzero(group_len_ratio < 5.0 / 1000)
+    # groups with less than 0.5% of the regions, compared without a division
+    problem = np.flatnonzero(np.diff(hm.matrix.group_boundaries) * 1000 < 5 * len(hm.matrix.regions))
+    if problem.size:
         sys.stderr.write("WARNING: Group '{}' is too small for plotting, you might want to remove it. "
                          "There will likely be an error message from matplotlib regarding this "
                          "below.\n".format(hm.matrix.group_labels[problem[0]]))
@@ -842,11 +1051,12 @@ def main(args=None):
     if args.sortRegions != 'no':
         sortUsingSamples = []
         if args.sortUsingSamples is not None:
-            for i in args.sortUsingSamples:
-                if (i > 0 and i <= hm.matrix.get_num_samples()):
-                    sortUsingSamples.append(i - 1)
-                else:
-                    exit("The value {0} for --sortSamples is not valid. Only values from 1 to {1} are allowed.".format(args.sortUsingSamples, hm.matrix.get_num_samples()))
+            samples = np.asarray(args.sortUsingSamples, dtype=np.int64)
+            num_samples = hm.matrix.get_num_samples()
+            invalid = (samples < 1) | (samples > num_samples)
+            if invalid.any():
+                exit("The values {0} for --sortUsingSamples are not valid. Only values from 1 to {1} are allowed.".format(samples[invalid].tolist(), num_samples))
+            sortUsingSamples = (samples - 1).tolist()
             print('Samples used for ordering within each group: ', sortUsingSamples)
 
         hm.matrix.sort_groups(sort_using=args.sortUsing,
@@ -857,7 +1067,7 @@ def main(args=None):
         if args.kmeans is not None:
             hm.matrix.computeSilhouette(args.kmeans)
         elif args.hclust is not None:
-            hm.matrix.computeSilhouette(args.args.hclust)
+            hm.matrix.computeSilhouette(args.hclust)
 
     if args.outFileNameMatrix:
         hm.save_matrix(args.outFileNameMatrix)
@@ -865,6 +1075,11 @@ def main(args=None):
     if args.outFileSortedRegions:
         hm.save_BED(args.outFileSortedRegions)
 
+    # from here on the values are only plotted. The heatmaps have (usually)
+    # 256 colors, thus single precision halves the memory at no visible cost
+    if hm.matrix.matrix.dtype == np.float64:
+        hm.matrix.matrix = hm.matrix.matrix.astype(np.float32)
+
     colormap_dict = {'colorMap': args.colorMap,
                      'colorList': args.colorList,
                      'colorNumber': args.colorNumber,
@@ -1,6 +1,8 @@
 import os
 import sys
+from tempfile import NamedTemporaryFile
 
+import matplotlib
 import deeptools.computeMatrix
 import deeptools.plotHeatmap
 import deeptools.plotProfile
@@ -246,3 +248,53 @@ def test_chopRegionsFromMiddle():
     assert(downstream == [(300, 400), (800, 900)])
     assert(padLeft == 100)
     assert(padRight == 50)
+
+
+def test_plotHeatmap_hclust_silhouette():
+    outfile = NamedTemporaryFile(suffix='.png', prefix='plotHeatmap_test_', delete=False)
+    sorted_regions = NamedTemporaryFile(suffix='.bed', prefix='plotHeatmap_test_', delete=False)
+    args = "-m {}/large_matrix.mat.gz --outFileName {} --outFileSortedRegions {} " \
+           "--hclust 2 --silhouette".format(ROOT, outfile.name, sorted_regions.name).split()
+    # plotHeatmap changes the global font size, keep it from leaking into the image tests
+    with matplotlib.rc_context():
+        deeptools.plotHeatmap.main(args)
+    with open(sorted_regions.name) as f:
+        header = f.readline().rstrip("\n").split("\t")
+        lines = [line.rstrip("\n").split("\t") for line in f]
+    assert header[-1] == "silhouette"
+    assert len(lines) > 0
+    assert set(line[12] for line in lines) == set(["cluster_1", "cluster_2"])
+    for line in lines:
+        assert -1 <= float(line[-1]) <= 1
+    os.remove(outfile.name)
+    os.remove(sorted_regions.name)
+
+
+def test_plotHeatmap_downsampled_heatmap():
+    """
+    Heatmaps with many more rows than pixels are averaged down before they are
+    drawn, which should look like the clipped full resolution heatmap.
+    """
+    hm = deeptools.heatmapper.heatmapper()
+    hm.read_matrix_file(ROOT + "large_matrix.mat.gz")
+    full, rows, cols, vmin, vmax = deeptools.plotHeatmap.prepare_heatmap_image(hm, 0, 0, None, 3, 4999, 'bilinear')
+    small, _, _, small_vmin, small_vmax = deeptools.plotHeatmap.prepare_heatmap_image(hm, 0, 0, None, 3, 200, 'bilinear')
+    assert full.shape == (4999, 40)
+    assert small.shape == (209, 40)
+    # the missing zMin is taken from all rows
+    assert (small_vmin, small_vmax) == (vmin, vmax)
+    assert abs(small.mean() - full.mean()) < 1
+    assert (small == 255).mean() <= (full == 255).mean()
+
+
+def test_plotHeatmap_zmin_only_nearest():
+    """
+    The missing zMax has to be taken from the clipped values, otherwise it can
+    be smaller than the given zMin.
+    """
+    outfile = NamedTemporaryFile(suffix='.png', prefix='plotHeatmap_test_', delete=False)
+    args = "-m {}../test_data/computeMatrixOperations.mat.gz --outFileName {} " \
+           "--zMin 1000 --interpolationMethod nearest".format(ROOT, outfile.name).split()
+    with matplotlib.rc_context():
+        deeptools.plotHeatmap.main(args)
+    os.remove(outfile.name)